@@ -4,28 +4,49 @@ from tmr import TMR
 from tacs import TACS, elements, constitutive, functions
 import numpy as np
 import argparse
+import functools
 import os
+from concurrent.futures import ThreadPoolExecutor
 import ksFSDT
 
+# The compiled KS kernel is optional, fall back to NumPy without it
+try:
+    import ks_kernel
+except ImportError:
+    ks_kernel = None
+
 
 def integrate(integrand):
-    sigma = [17.0 / 48.0, 59.0 / 48.0, 43.0 / 48, 49 / 48.9]
+    sigma = np.array([17.0 / 48.0, 59.0 / 48.0, 43.0 / 48.0, 49.0 / 48.0])
     r = len(sigma)
 
-    integral = 0.0
-    for i, s in enumerate(sigma):
-        integral += s * integrand[i]
-        integral += s * integrand[-1 - i]
-
-    for i in range(r, len(integrand) - r):
-        integral += integrand[i]
+    integral = np.dot(sigma, integrand[:r] + integrand[: -r - 1 : -1])
+    integral += np.sum(integrand[r:-r])
 
     return integral
 
 
 def cylinder_ks_functional(
-    functional, rho, t, E, nu, kcorr, ys, L, R, alpha, beta, load, n=1000
+    functional,
+    rho,
+    t,
+    E,
+    nu,
+    kcorr,
+    ys,
+    L,
+    R,
+    alpha,
+    beta,
+    load,
+    n=1000,
+    dtype=np.float64,
 ):
+    """
+    Cylinder subject to a sinusoidal pressure load. The KS integrand is
+    evaluated on an n x n grid using the given floating point type, but
+    is always accumulated in double precision.
+    """
     A = np.zeros((5, 5))
     rhs = np.zeros(5)
     rhs[2] = -load
@@ -156,28 +177,61 @@ def cylinder_ks_functional(
     y = 3.0 * c2**2
     vm_max = max(vm_max, np.sqrt(x * y / (x + y)), np.sqrt(x), np.sqrt(y))
 
-    tcoef1 = a1**2 + b1**2 - a1 * b1
-    tcoef2 = 3 * c1**2
-    bcoef1 = a2**2 + b2**2 - a2 * b2
-    bcoef2 = 3 * c2**2
-
-    x = np.linspace(0.0, L, n)
-    y = np.linspace(0.0, 2.0 * np.pi * R, n)
-    X, Y = np.meshgrid(x, y)
-
-    # Compute the contribution from both stress components
-    sin2 = (np.sin(alpha * Y) * np.sin(beta * X)) ** 2
-    cos2 = (np.cos(alpha * Y) * np.cos(beta * X)) ** 2
-    vm1 = np.sqrt((tcoef1 * sin2 + tcoef2 * cos2))
-    vm2 = np.sqrt((bcoef1 * sin2 + bcoef2 * cos2))
-    S = np.exp(rho * (vm1 - vm_max)) + np.exp(rho * (vm2 - vm_max))
+    # Set the grid coefficients in the working precision
+    real = np.dtype(dtype).type
+    tcoef1 = real(a1**2 + b1**2 - a1 * b1)
+    tcoef2 = real(3 * c1**2)
+    bcoef1 = real(a2**2 + b2**2 - a2 * b2)
+    bcoef2 = real(3 * c2**2)
+    grid_max = real(vm_max)
+    grid_rho = real(rho)
 
-    # Integrate over the area
     h = (2.0 * L * R * np.pi) / (n - 1) ** 2
-    ks_sum = 0.0
-    for j in range(n - 1):
-        for i in range(n - 1):
-            ks_sum += S[i, j] + S[i + 1, j] + S[i, j + 1] + S[i + 1, j + 1]
+    if ks_kernel is not None and real is np.float64:
+        # Use the compiled kernel that never forms the grid
+        ks_sum = ks_kernel.cylinder_ks_sum(
+            alpha, beta, L, R, tcoef1, tcoef2, bcoef1, bcoef2, rho, vm_max, n
+        )
+    else:
+        x = np.linspace(0.0, L, n, dtype=dtype)
+        y = np.linspace(0.0, 2.0 * np.pi * R, n, dtype=dtype)
+
+        # The x-dependent factors are shared by every row of the grid
+        sx = np.sin(real(beta) * x)[np.newaxis, :]
+        cx = np.cos(real(beta) * x)[np.newaxis, :]
+
+        # Integrate over the area in blocks of rows so that the working
+        # set for each block stays in cache. Adjacent blocks share a row.
+        tile = 256
+        ks_sum = 0.0
+        for i0 in range(0, n - 1, tile):
+            yr = y[i0 : min(i0 + tile, n - 1) + 1, np.newaxis]
+
+            # Compute the contribution from both stress components
+            sin2 = (np.sin(real(alpha) * yr) * sx) ** 2
+            cos2 = (np.cos(real(alpha) * yr) * cx) ** 2
+
+            # Evaluate exp(rho*(vm - vm_max)) for the top surface in place
+            S = np.multiply(tcoef1, sin2)
+            S += np.multiply(tcoef2, cos2)
+            np.sqrt(S, out=S)
+            S -= grid_max
+            S *= grid_rho
+            np.exp(S, out=S)
+
+            # Re-use the sin2/cos2 arrays for the bottom surface contribution
+            sin2 *= bcoef1
+            cos2 *= bcoef2
+            sin2 += cos2
+            np.sqrt(sin2, out=sin2)
+            sin2 -= grid_max
+            sin2 *= grid_rho
+            np.exp(sin2, out=sin2)
+            S += sin2
+
+            ks_sum += np.sum(
+                S[:-1, :-1] + S[1:, :-1] + S[:-1, 1:] + S[1:, 1:], dtype=np.float64
+            )
     ks_sum = 0.25 * h * ks_sum
 
     return vm_max, vm_max + np.log(ks_sum) / rho
@@ -196,8 +250,6 @@ def disk_ks_functional(functional, rho, t, E, nu, kcorr, ys, R, load, n=1000):
 
     # Compute the value of the radii
     r0 = np.linspace(0, R, n)
-    S = np.zeros((n, 2))
-    w0 = np.zeros(n)
 
     # Set the transverse displacement
     w0 = load * (
@@ -206,57 +258,21 @@ def disk_ks_functional(functional, rho, t, E, nu, kcorr, ys, R, load, n=1000):
     )
 
     if functional == "ks" or functional == "pnorm":
-        # Do the work to compute the stresses
-        phi_over_r0 = load * (R**2 / (16 * D))
-        dphidr0 = load * (R**2 / (16 * D))
-
-        # Compute the value of the stress at the top surface
-        z1 = 0.5 * t
-        err = z1 * dphidr0
-        ett = z1 * phi_over_r0
-
-        srr = Q11 * err + Q12 * ett
-        stt = Q12 * err + Q22 * ett
-
-        # Compute the von Mises at the top surface
-        S[0, 0] = np.sqrt(srr**2 + stt**2 - srr * stt) / ys
-
-        # Compute the value of the stress at the bottom surface
-        z2 = -0.5 * t
-        err = z2 * dphidr0
-        ett = z2 * phi_over_r0
-
-        srr = Q11 * err + Q12 * ett
-        stt = Q12 * err + Q22 * ett
-
-        # Compute the von Mises at the bottom surface
-        S[0, 1] = np.sqrt(srr**2 + stt**2 - srr * stt) / ys
-
-        # The value of the rotation
-        phi = load * (R**3 / (16 * D)) * (r0[1:] / R) * (1 - (r0[1:] / R) ** 2)
-        dphidr = load * (R**2 / (16 * D)) * (1 - 3 * (r0[1:] / R) ** 2)
-
-        # Compute the value of the stress at the top surface
-        z1 = 0.5 * t
-        err = z1 * dphidr
-        ett = z1 * phi / r0[1:]
-
-        srr = Q11 * err + Q12 * ett
-        stt = Q12 * err + Q22 * ett
+        # The value of the rotation divided by the radius and its
+        # derivative. Both are well-defined at r0 = 0.
+        phi_over_r0 = load * (R**2 / (16 * D)) * (1 - (r0 / R) ** 2)
+        dphidr = load * (R**2 / (16 * D)) * (1 - 3 * (r0 / R) ** 2)
 
-        # Compute the von Mises at the top surface
-        S[1:, 0] = np.sqrt(srr**2 + stt**2 - srr * stt) / ys
-
-        # Compute the value of the stress at the bottom surface
-        z2 = -0.5 * t
-        err = z2 * dphidr
-        ett = z2 * phi / r0[1:]
+        # Compute the value of the strain at the top and bottom surfaces
+        z = np.array([0.5 * t, -0.5 * t])
+        err = np.outer(dphidr, z)
+        ett = np.outer(phi_over_r0, z)
 
         srr = Q11 * err + Q12 * ett
         stt = Q12 * err + Q22 * ett
 
-        # Compute the von Mises at the bottom surface
-        S[1:, 1] = np.sqrt(srr**2 + stt**2 - srr * stt) / ys
+        # Compute the von Mises stress at both surfaces
+        S = np.sqrt(srr**2 + stt**2 - srr * stt) / ys
 
         # Compute the maximum von Mises stress
         max_value = np.max(S)
@@ -276,16 +292,21 @@ def disk_ks_functional(functional, rho, t, E, nu, kcorr, ys, R, load, n=1000):
         pow_sum = (R / (n - 1)) * integrate(integrand)
         functional_estimate = max_value * pow_sum
     elif functional == "ks":
-        integrand = r0 * (
-            np.exp(rho * (S[:, 0] - max_value)) + np.exp(rho * (S[:, 1] - max_value))
-        )
+        # Evaluate the integrand in place for both surfaces
+        S -= max_value
+        S *= rho
+        np.exp(S, out=S)
+        integrand = np.add(S[:, 0], S[:, 1])
+        integrand *= r0
 
         ks_sum = 2 * np.pi * (R / (n - 1)) * integrate(integrand)
         functional_estimate = max_value + np.log(ks_sum) / rho
     elif functional == "pnorm":
-        integrand = r0 * (
-            np.power((S[:, 0] / max_value), rho) + np.power((S[:, 1] / max_value), rho)
-        )
+        # Evaluate the integrand in place for both surfaces
+        S /= max_value
+        np.power(S, rho, out=S)
+        integrand = np.add(S[:, 0], S[:, 1])
+        integrand *= r0
 
         pow_sum = 2 * np.pi * (R / (n - 1)) * integrate(integrand)
         functional_estimate = max_value * pow_sum
@@ -295,72 +316,26 @@ def disk_ks_functional(functional, rho, t, E, nu, kcorr, ys, R, load, n=1000):
 
 def recon_basis(degree, x):
     """
-    Get the quadratic shape functions centered about the point pt
+    Get the polynomial reconstruction basis of the given degree at the
+    point x, or at each row of an (npts, 2) array of points
     """
 
-    if degree == 2:
-        N = np.array([1.0, x[0], x[1], x[0] * x[0], x[0] * x[1], x[1] * x[1]])
-    elif degree == 3:
-        N = np.array(
-            [
-                1.0,
-                x[0],
-                x[1],
-                x[0] * x[0],
-                x[0] * x[1],
-                x[1] * x[1],
-                x[0] * x[0] * x[0],
-                x[0] * x[0] * x[1],
-                x[0] * x[1] * x[1],
-                x[1] * x[1] * x[1],
-            ]
-        )
-    elif degree == 4:
-        N = np.array(
-            [
-                1.0,
-                x[0],
-                x[1],
-                x[0] * x[0],
-                x[0] * x[1],
-                x[1] * x[1],
-                x[0] * x[0] * x[0],
-                x[0] * x[0] * x[1],
-                x[0] * x[1] * x[1],
-                x[1] * x[1] * x[1],
-                x[0] * x[0] * x[0] * x[0],
-                x[0] * x[0] * x[0] * x[1],
-                x[0] * x[0] * x[1] * x[1],
-                x[0] * x[1] * x[1] * x[1],
-                x[1] * x[1] * x[1] * x[1],
-            ]
-        )
-    elif degree == 5:
-        N = np.array(
-            [
-                1.0,
-                x[0],
-                x[1],
-                x[0] * x[0],
-                x[0] * x[1],
-                x[1] * x[1],
-                x[0] * x[0] * x[0],
-                x[0] * x[0] * x[1],
-                x[0] * x[1] * x[1],
-                x[1] * x[1] * x[1],
-                x[0] * x[0] * x[0] * x[0],
-                x[0] * x[0] * x[0] * x[1],
-                x[0] * x[0] * x[1] * x[1],
-                x[0] * x[1] * x[1] * x[1],
-                x[1] * x[1] * x[1] * x[1],
-                x[0] * x[0] * x[0] * x[0] * x[0],
-                x[0] * x[0] * x[0] * x[0] * x[1],
-                x[0] * x[0] * x[0] * x[1] * x[1],
-                x[0] * x[0] * x[1] * x[1] * x[1],
-                x[0] * x[1] * x[1] * x[1] * x[1],
-                x[1] * x[1] * x[1] * x[1] * x[1],
-            ]
-        )
+    x = np.asarray(x)
+    u = x[..., 0]
+    v = x[..., 1]
+
+    # Compute the powers of each coordinate
+    pu = [np.ones_like(u)]
+    pv = [np.ones_like(v)]
+    for k in range(degree):
+        pu.append(pu[-1] * u)
+        pv.append(pv[-1] * v)
+
+    # Order the monomials by total degree, then by decreasing power of u
+    N = np.stack(
+        [pu[k - j] * pv[j] for k in range(degree + 1) for j in range(k + 1)],
+        axis=-1,
+    )
 
     return N
 
@@ -375,10 +350,8 @@ def compute_plane(P):
     cent = np.average(P, axis=0)
 
     # Compute the covariance matrix
-    A = np.zeros((3, 3))
-    for i, pt in enumerate(P):
-        d = pt - cent
-        A += np.outer(d, d)
+    D = P - cent
+    A = np.dot(D.T, D)
 
     eig, v = np.linalg.eigh(A)
 
@@ -388,49 +361,69 @@ def compute_plane(P):
     return B, cent
 
 
-def elem_recon(degree, conn, Xpts, uvals, elem_list, dist=1.0):
-    # Get a unique list of the nodes in the list
-    var = []
-    for elem in elem_list:
-        var.extend(conn[elem])
+def compute_elem_to_elem(conn):
+    """
+    Compute the element->element connectivity (elements sharing at least
+    one node) as CSR arrays (ptr, elems)
+    """
 
-    # Get a unique list of values
-    var = sorted(list(set(var)))
+    nelems, nodes_per_elem = conn.shape
+    flat = conn.ravel()
+    elems = np.repeat(np.arange(nelems), nodes_per_elem)
 
-    # Create the patch of points
-    Xpt = []
-    for i, v in enumerate(var):
-        Xpt.append(Xpts[v, :])
+    # Create the node->element connectivity by sorting on the node number
+    perm = np.argsort(flat, kind="stable")
+    node_elems = elems[perm]
+    node_count = np.bincount(flat)
+    node_ptr = np.zeros(len(node_count) + 1, dtype=np.intp)
+    np.cumsum(node_count, out=node_ptr[1:])
+
+    # Pair every (element, node) entry with all the elements at that node
+    count = node_count[flat]
+    offset = np.arange(np.sum(count)) - np.repeat(np.cumsum(count) - count, count)
+    rows = np.repeat(elems, count)
+    cols = node_elems[np.repeat(node_ptr[flat], count) + offset]
 
-    # Convert the result into an array
-    Xpt = np.array(Xpt)
+    # Remove the duplicates - the unique pairs come out sorted by row
+    pairs = np.unique(rows * nelems + cols)
+    rows = pairs // nelems
+    cols = pairs % nelems
+
+    ptr = np.zeros(nelems + 1, dtype=np.intp)
+    np.cumsum(np.bincount(rows, minlength=nelems), out=ptr[1:])
+
+    return ptr, cols
+
+
+def elem_recon(degree, conn, Xpts, uvals, elem_list, dist=1.0):
+    # Get a unique, sorted list of the nodes in the patch
+    var = np.unique(conn[elem_list].ravel())
+
+    # Create the patch of points
+    Xpt = Xpts[var, :]
 
     # Compute the solution to find the best planar fit
     B, cent = compute_plane(Xpt)
 
     # Find the uv parametric locations for all points
-    uv = []
-    for i, pt in enumerate(Xpt):
-        uv.append(np.dot(B, pt - cent))
-
-    # Loop over the adjacent nodes and fit them
-    dim = 6
-    if degree == 3:
-        dim = 10
-    elif degree == 4:
-        dim = 15
-    elif degree == 5:
-        dim = 21
-    A = np.zeros((len(var), dim))
-    b = np.zeros((len(var), 6))
-
-    for i, v in enumerate(var):
-        # Compute the basis at the provided point
-        b[i, :] = uvals[6 * v : 6 * (v + 1)]
-        A[i, :] = recon_basis(degree, uv[i] / dist)
-
-    # Fit the basis
-    vals, res, rank, s = np.linalg.lstsq(A, b, rcond=-1)
+    uv = np.dot(Xpt - cent, B.T)
+
+    # Compute the basis at all the points in the patch and fit them
+    A = recon_basis(degree, uv / dist)
+    b = uvals.reshape(-1, 6)[var, :]
+
+    # Fit the basis using the normal equations. The patch basis is
+    # scaled by dist so the Gram matrix is usually well-conditioned,
+    # otherwise fall back to the SVD-based least squares solution.
+    try:
+        L = np.linalg.cholesky(np.dot(A.T, A))
+        d = np.diag(L)
+        if (d.max() / d.min()) ** 2 > 1e8:
+            raise np.linalg.LinAlgError
+        y = np.linalg.solve(L, np.dot(A.T, b))
+        vals = np.linalg.solve(L.T, y)
+    except np.linalg.LinAlgError:
+        vals, res, rank, s = np.linalg.lstsq(A, b, rcond=-1)
 
     return vals, B, cent
 
@@ -443,31 +436,17 @@ def computeRecon(degree, conn, Xpts, uvals, conn_refine, Xpts_refine):
     # Compute the element->element connectivity
     nelems = conn.shape[0]
 
-    # Create a node->element dictionary
-    node_to_elems = {}
-    for i in range(nelems):
-        for node in conn[i, :]:
-            if node in node_to_elems:
-                node_to_elems[node][i] = True
-            else:
-                node_to_elems[node] = {i: True}
-
-    # Now create an elements to elements list
-    elem_to_elem = []
-    for i in range(nelems):
-        elems = {}
-        for node in conn[i, :]:
-            for elem in node_to_elems[node]:
-                elems[elem] = True
-        elem_to_elem.append(elems.keys())
+    # Compute the element->element connectivity in CSR format
+    elem_ptr, elem_to_elem = compute_elem_to_elem(conn)
 
     # Get the refined shape
     uvals_refine = np.zeros(6 * Xpts_refine.shape[0])
+    uvals_nodes = uvals_refine.reshape(-1, 6)
     count = np.zeros(Xpts_refine.shape[0])
 
     for elem in range(nelems):
         # Get the list of elements
-        elem_list = elem_to_elem[elem]
+        elem_list = elem_to_elem[elem_ptr[elem] : elem_ptr[elem + 1]]
 
         # Compute the characteristic element distance
         X1 = Xpts[conn[elem, 0], :]
@@ -477,19 +456,20 @@ def computeRecon(degree, conn, Xpts, uvals, conn_refine, Xpts_refine):
         # Get the reconstructed values
         vals, B, cent = elem_recon(degree, conn, Xpts, uvals, elem_list, dist=dist)
 
-        # Compute the refined contributions to each element
-        for node in conn_refine[elem, :]:
-            # Compute the uv location on the plane
-            upt = np.dot(B, (Xpts_refine[node, :] - cent) / dist)
+        # Compute the uv locations of the refined nodes on the plane
+        nodes = conn_refine[elem, :]
+        upts = np.dot(Xpts_refine[nodes, :] - cent, B.T) / dist
+
+        # Reconstruct the basis at all the refined nodes at once
+        N = recon_basis(degree, upts)
+        contrib = np.dot(N, vals)
 
-            # Reconstruct the basis
-            N = recon_basis(degree, upt)
-            uvals_refine[6 * node : 6 * (node + 1)] += np.dot(N, vals)
-            count[node] += 1.0
+        # Scatter the refined contributions from this element
+        np.add.at(uvals_nodes, nodes, contrib)
+        np.add.at(count, nodes, 1.0)
 
     # Average the values
-    for i in range(6):
-        uvals_refine[i::6] /= count
+    uvals_nodes /= count[:, np.newaxis]
 
     return uvals_refine
 
@@ -511,10 +491,8 @@ def computeReconSolution(
     conn_refined = forest_refined.getMeshConn()
 
     # Find the min/max values
-    num_dep = -np.min(conn)
-    num_vars = np.max(conn) + 1
-    num_dep_refined = -np.min(conn_refined)
-    num_vars_refined = np.max(conn_refined) + 1
+    num_dep, num_vars = -conn.min(), conn.max() + 1
+    num_dep_refined, num_vars_refined = -conn_refined.min(), conn_refined.max() + 1
 
     # Adjust the indices so that they are always positive
     conn += num_dep
@@ -532,7 +510,6 @@ def computeReconSolution(
     values = ans.getValues(var)
 
     # Perform the reconstruction on each component individually
-    ans_array = np.zeros(6 * (num_vars_refined + num_dep_refined))
     ans_array = computeRecon(degree, conn, Xpts, values, conn_refined, Xpts_refined)
 
     # Set the values
@@ -596,17 +573,27 @@ def shape_funcs(order, x):
     return n, nx
 
 
-def get_shape_funcs(order, pt):
-    """Get the shape functions for the given element order"""
-    n1, n1x = shape_funcs(order, pt[0])
-    n2, n2x = shape_funcs(order, pt[1])
+@functools.lru_cache(maxsize=None)
+def _get_shape_funcs(order, u, v):
+    n1, n1x = shape_funcs(order, u)
+    n2, n2x = shape_funcs(order, v)
+
+    N = np.multiply.outer(n2, n1).ravel()
+    Na = np.multiply.outer(n2, n1x).ravel()
+    Nb = np.multiply.outer(n2x, n1).ravel()
+
+    # The cached arrays are shared between callers
+    for arr in (N, Na, Nb):
+        arr.flags.writeable = False
 
-    N = np.outer(n2, n1).flatten()
-    Na = np.outer(n2, n1x).flatten()
-    Nb = np.outer(n2x, n1).flatten()
     return N, Na, Nb
 
 
+def get_shape_funcs(order, pt):
+    """Get the shape functions for the given element order"""
+    return _get_shape_funcs(order, float(pt[0]), float(pt[1]))
+
+
 class disk_exact:
     def __init__(self, load, E, nu, kcorr, R, t):
         self.load = load
@@ -634,26 +621,37 @@ def compute_solution_error(comm, order, assembler, exact_callback):
 
     # Get the quadrature for the given element order
     wts, pts = get_quadrature(order + 1)
-
-    err = 0.0
+    wts = np.array(wts)
+
+    # The shape functions at the quadrature points are the same for
+    # every element so evaluate them once as (nquad, nnodes) matrices
+    shape = [get_shape_funcs(order, pt) for pt in pts]
+    Nmat = np.array([N for N, Na, Nb in shape])
+    Namat = np.array([Na for N, Na, Nb in shape])
+    Nbmat = np.array([Nb for N, Na, Nb in shape])
+
+    # Gather the node locations and transverse displacements of all
+    # the elements in a single pass
+    nnodes = Nmat.shape[1]
+    Xpts = np.zeros((nelems, nnodes, 3))
+    wvals = np.zeros((nelems, nnodes))
     for i in range(nelems):
         # Get the information about the given element
         elem, Xpt, vrs, dvars, ddvars = assembler.getElementData(i)
-        Xpt = np.array(Xpt).reshape(-1, 3).T
-        vrs = np.array(vrs)
-
-        # Compute the quadrature points/weights over the element
-        for wt, pt in zip(wts, pts):
-            N, Na, Nb = get_shape_funcs(order, pt)
-            X = np.dot(Xpt, N)
-            Xa = np.dot(Xpt, Na)
-            Xb = np.dot(Xpt, Nb)
-            normal = np.cross(Xa, Xb)
-            detJ = np.sqrt(np.dot(normal, normal))
-
-            w = np.dot(vrs[2::6], N)
-            w_exact = exact_callback(X)
-            err += wt * detJ * (w - w_exact) ** 2
+        Xpts[i, :, :] = np.reshape(Xpt, (-1, 3))
+        wvals[i, :] = vrs[2::6]
+
+    # Compute the quadrature points/weights over all the elements at
+    # once. The point arrays are (3, nelems, nquad).
+    X = np.einsum("qn,enj->jeq", Nmat, Xpts)
+    Xa = np.einsum("qn,enj->jeq", Namat, Xpts)
+    Xb = np.einsum("qn,enj->jeq", Nbmat, Xpts)
+    normal = np.cross(Xa, Xb, axis=0)
+    detJ = np.sqrt(np.sum(normal**2, axis=0))
+
+    w = np.dot(wvals, Nmat.T)
+    w_exact = exact_callback(X)
+    err = np.sum(np.dot(detJ * (w - w_exact) ** 2, wts))
 
     err = comm.allreduce(err, op=MPI.SUM)
 
@@ -716,6 +714,35 @@ def addFaceTraction(case, order, assembler, load):
     return aux
 
 
+def createKSFailure(ftype):
+    def create(assembler):
+        func = functions.KSFailure(assembler, ksweight)
+        func.setKSFailureType(ftype)
+        return func
+
+    return create
+
+
+def createKSDisplacement(ftype, direction=(0.0, 0.0, 1.0)):
+    def create(assembler):
+        func = functions.KSDisplacement(assembler, ksweight, list(direction))
+        func.setKSDispType(ftype)
+        return func
+
+    return create
+
+
+def get_buffer(buf, shape):
+    """
+    Get a view of the given shape into buf, growing the buffer
+    geometrically when it is too small
+    """
+    size = int(np.prod(shape))
+    if buf is None or buf.shape[0] < size:
+        buf = np.empty(max(size, 0 if buf is None else 2 * buf.shape[0]))
+    return buf, buf[:size].reshape(shape)
+
+
 def createProblem(
     case, forest, bcs, ordering, ordr=2, nlevels=2, pttype=TMR.UNIFORM_POINTS
 ):
@@ -888,14 +915,18 @@ elif case == "disk":
     D = ((t**3) / 12) * E / (1.0 - nu**2)
     G = 0.5 * E / (1.0 + nu)
 
-    # Compute the exact KS value
-    for n in [1000, 10000, 100000, 1000000, 10000000]:
-        one, approx = disk_ks_functional(
+    # Compute the exact KS value. The end-corrected trapezoid rule is
+    # fourth-order accurate, so Richardson extrapolate from two grids
+    # where the spacing is halved instead of refining the integral further.
+    approx = []
+    for n in [100001, 200001]:
+        one, value = disk_ks_functional(
             functional, ksweight, t, E, nu, kcorr, ys, R, load, n=n
         )
         if comm.rank == 0:
-            print("%10d %25.16e" % (n, approx))
-        exact_functional = approx
+            print("%10d %25.16e" % (n, value))
+        approx.append(value)
+    exact_functional = (16.0 * approx[1] - approx[0]) / 15.0
 
     # Load the geometry model
     geo = TMR.LoadModel("2d-disk.stp")
@@ -972,18 +1003,46 @@ if args.remesh_domain:
         descript += "_%g" % (args.element_count_target)
 
 # Create the log file and write out the header
-log_fp = open("results/%s.dat" % (descript), "w")
+log_fp = open("results/%s.dat" % (descript), "w", buffering=1)
 s = "Variables = iter, nelems, nnodes, fval, fcorr, abs_err, adjoint_corr, "
 s += "exact, fval_error, fval_corr_error, "
 s += "fval_effectivity, indicator_effectivity\n"
 log_fp.write(s)
 
 if case == "disk" and args.compute_solution_error:
-    sol_log_fp = open("solution_error_%s.dat" % (descript), "w")
+    sol_log_fp = open("solution_error_%s.dat" % (descript), "w", buffering=1)
     s = "Variables = iter, nelems, nnodes, "
     s += "solution_error, recon_solution_error\n"
     sol_log_fp.write(s)
 
+# Select how the functional is created on the original and refined
+# meshes once, rather than on every adaptive step
+createFunction = {
+    "ks": createKSFailure("continuous"),
+    "pnorm": createKSFailure("pnorm-continuous"),
+    "ks_disp": createKSDisplacement("continuous"),
+    "pnorm_disp": createKSDisplacement("pnorm-continuous"),
+}[functional]
+
+# Set the bins used to compute the refinement from the error estimate
+low = -16
+high = 4
+bins_per_decade = 10
+nbins = bins_per_decade * (high - low)
+bounds = 10 ** np.linspace(high, low, nbins + 1)
+asc_bounds = np.ascontiguousarray(bounds[::-1])
+bins = np.zeros(nbins + 2, dtype=np.intc)
+
+# Buffers for the element centroids and errors when remeshing
+Xp_buf = None
+errors_buf = None
+Xpt_buf = None
+
+# Write the histogram data on a background thread. The pending write
+# is checked before the next one starts so that errors are raised.
+io_pool = ThreadPoolExecutor(max_workers=1)
+io_future = None
+
 for k in range(steps):
     # Create the topology problem
     if args.remesh_domain:
@@ -1032,21 +1091,7 @@ for k in range(steps):
     f5.writeToFile("results/%s_solution%02d.f5" % (descript, k))
 
     # Create and compute the function
-    fval = 0.0
-    direction = [0.0, 0.0, 1.0]
-    if functional == "ks":
-        func = functions.KSFailure(assembler, ksweight)
-        func.setKSFailureType("continuous")
-    elif functional == "pnorm":
-        func = functions.KSFailure(assembler, ksweight)
-        func.setKSFailureType("pnorm-continuous")
-    elif functional == "ks_disp":
-        func = functions.KSDisplacement(assembler, ksweight, direction)
-        func.setKSDispType("continuous")
-    elif functional == "pnorm_disp":
-        func = functions.KSDisplacement(assembler, ksweight, direction)
-        func.setKSDispType("pnorm-continuous")
-
+    func = createFunction(assembler)
     fval = assembler.evalFunctions([func])[0]
 
     # Allocate variables
@@ -1102,22 +1147,7 @@ for k in range(steps):
 
         # Compute the functional and the right-hand-side for the
         # adjoint on the refined mesh
-        if functional == "ks":
-            func_refined = functions.KSFailure(assembler_refined, ksweight)
-            func_refined.setKSFailureType("continuous")
-        elif functional == "pnorm":
-            func_refined = functions.KSFailure(assembler_refined, ksweight)
-            func_refined.setKSFailureType("pnorm-continuous")
-        elif functional == "ks_disp":
-            func_refined = functions.KSDisplacement(
-                assembler_refined, ksweight, direction
-            )
-            func_refined.setKSDispType("continuous")
-        elif functional == "pnorm_disp":
-            func_refined = functions.KSDisplacement(
-                assembler_refined, ksweight, direction
-            )
-            func_refined.setKSDispType("pnorm-continuous")
+        func_refined = createFunction(assembler_refined)
 
         # Evaluate the functional on the refined mesh
         fval_refined = assembler_refined.evalFunctions([func_refined])[0]
@@ -1189,33 +1219,35 @@ for k in range(steps):
     f5_refine = TACS.ToFH5(assembler_refined, TACS.PY_SHELL, flag)
     f5_refine.writeToFile("results/solution_refined%02d.f5" % (k))
 
-    # Compute the refinement from the error estimate
-    low = -16
-    high = 4
-    bins_per_decade = 10
-    nbins = bins_per_decade * (high - low)
-    bounds = 10 ** np.linspace(high, low, nbins + 1)
-    bins = np.zeros(nbins + 2, dtype=np.int)
+    # Sum the error estimate, the number of elements, the first two
+    # moments of log(error) and the number of nodes across all procs
+    log_error = np.log(error)
+    sums = np.array(
+        [
+            np.sum(error),
+            assembler.getNumElements(),
+            np.sum(log_error),
+            np.dot(log_error, log_error),
+            assembler.getNumOwnedNodes(),
+        ],
+        dtype=np.float64,
+    )
+    comm.Allreduce(MPI.IN_PLACE, sums, op=MPI.SUM)
+    err_est = sums[0]
+    ntotal = int(sums[1])
+    nnodes = int(sums[4])
 
     # Compute the mean and standard deviations of the log(error)
-    err_est = comm.allreduce(np.sum(error), op=MPI.SUM)
-    ntotal = comm.allreduce(assembler.getNumElements(), op=MPI.SUM)
-    mean = comm.allreduce(np.sum(np.log(error)), op=MPI.SUM)
-    mean /= ntotal
-
-    # Compute the standard deviation
-    stddev = comm.allreduce(np.sum((np.log(error) - mean) ** 2), op=MPI.SUM)
-    stddev = np.sqrt(stddev / (ntotal - 1))
-
-    # Get the total number of nodes
-    nnodes = comm.allreduce(assembler.getNumOwnedNodes(), op=MPI.SUM)
+    mean = sums[2] / ntotal
+    stddev = np.sqrt(max(0.0, sums[3] - ntotal * mean**2) / (ntotal - 1))
 
     # Compute the error from the exact solution
-    fval_error = np.fabs(exact_functional - fval)
-    fval_corr_error = np.fabs(exact_functional - fval_corr)
+    fval_diff = exact_functional - fval
+    fval_error = abs(fval_diff)
+    fval_corr_error = abs(exact_functional - fval_corr)
 
-    fval_effectivity = (fval_corr - fval) / (exact_functional - fval)
-    indicator_effectivity = err_est / np.fabs(exact_functional - fval)
+    fval_effectivity = (fval_corr - fval) / fval_diff
+    indicator_effectivity = err_est / fval_error
 
     # Write the log data to a file
     s = "%6d %6d %6d %20.15e %20.15e %20.15e %20.15e "
@@ -1237,7 +1269,6 @@ for k in range(steps):
             indicator_effectivity,
         )
     )
-    log_fp.flush()
 
     if case == "disk" and args.compute_solution_error:
         disk_model = disk_exact(load, E, nu, kcorr, R, t)
@@ -1251,21 +1282,15 @@ for k in range(steps):
             "%6d %6d %6d %20.15e %20.15e\n"
             % (k, ntotal, nnodes, solution_error, recon_solution_error)
         )
-        sol_log_fp.flush()
-
-    # Compute the bins
-    for i in range(len(error)):
-        if error[i] > bounds[0]:
-            bins[0] += 1
-        elif error[i] < bounds[-1]:
-            bins[-1] += 1
-        else:
-            for j in range(len(bounds) - 1):
-                if error[i] <= bounds[j] and error[i] > bounds[j + 1]:
-                    bins[j + 1] += 1
+
+    # Compute the bins. The bounds are in descending order so that bins[0]
+    # counts errors above bounds[0], bins[j + 1] counts the errors in
+    # (bounds[j + 1], bounds[j]] and bins[-1] counts errors below bounds[-1]
+    index = nbins + 1 - np.digitize(error, asc_bounds, right=True)
+    bins[:] = np.bincount(index, minlength=nbins + 2)
 
     # Compute the number of bins
-    bins = comm.allreduce(bins, MPI.SUM)
+    comm.Allreduce(MPI.IN_PLACE, bins, op=MPI.SUM)
 
     # Compute the sum of the bins
     total = np.sum(bins)
@@ -1278,14 +1303,15 @@ for k in range(steps):
         print("mean      = ", mean)
         print("stddev    = ", stddev)
 
-        # Set the data
-        data = np.zeros((nbins, 4))
-        for i in range(nbins - 1, -1, -1):
-            data[i, 0] = bounds[i]
-            data[i, 1] = bounds[i + 1]
-            data[i, 2] = bins[i + 1]
-            data[i, 3] = 100.0 * bins[i + 1] / total
-        np.savetxt("results/%s_data%d.txt" % (descript, k), data)
+        # Set the data and write it out in the background
+        data = np.column_stack(
+            (bounds[:-1], bounds[1:], bins[1:-1], 100.0 * bins[1:-1] / total)
+        )
+        if io_future is not None:
+            io_future.result()
+        io_future = io_pool.submit(
+            np.savetxt, "results/%s_data%d.txt" % (descript, k), data
+        )
 
     # Print out the error estimate
     assembler.setDesignVars(error)
@@ -1303,32 +1329,31 @@ for k in range(steps):
             nelems = assembler.getNumElements()
 
             # Allocate the positions
-            Xp = np.zeros((nelems, 3))
+            Xp_buf, Xp = get_buffer(Xp_buf, (nelems, 3))
             for i in range(nelems):
                 # Get the information about the given element
                 elem, Xpt, vrs, dvars, ddvars = assembler.getElementData(i)
 
                 # Get the approximate element centroid
-                Xp[i, :] = np.average(Xpt.reshape((-1, 3)), axis=0)
+                Xpt.reshape(-1, 3).mean(axis=0, out=Xp[i])
 
             # Prepare to collect things to the root processor (only
             # one where it is required)
             root = 0
 
-            # Get the element counts
+            # Get the element counts and offsets on all procs
+            size = np.array([error.shape[0]], dtype=np.intc)
+            count = np.empty(comm.size, dtype=np.intc)
+            comm.Allgather(size, count)
+            displ = np.cumsum(count) - count
+
             if comm.rank == root:
-                size = error.shape[0]
-                count = comm.gather(size, root=root)
-                count = np.array(count, dtype=np.int)
                 ntotal = np.sum(count)
 
-                errors = np.zeros(np.sum(count))
-                Xpt = np.zeros(3 * np.sum(count))
-                comm.Gatherv(error, [errors, count])
-                comm.Gatherv(Xp.flatten(), [Xpt, 3 * count])
-
-                # Reshape the point array
-                Xpt = Xpt.reshape(-1, 3)
+                errors_buf, errors = get_buffer(errors_buf, (ntotal,))
+                Xpt_buf, Xpt = get_buffer(Xpt_buf, (ntotal, 3))
+                comm.Gatherv(error, [errors, count, displ, MPI.DOUBLE], root=root)
+                comm.Gatherv(Xp, [Xpt, 3 * count, 3 * displ, MPI.DOUBLE], root=root)
 
                 # Asymptotic order of accuracy on per-element basis
                 s = order - 1
@@ -1363,16 +1388,12 @@ for k in range(steps):
 
                 # Set the values of
                 if feature_size is not None:
-                    for i, hp in enumerate(hvals):
-                        hlocal = feature_size.getFeatureSize(Xpt[i, :])
-                        hvals[i] = np.min(
-                            (np.max((hp * hlocal, 0.25 * hlocal)), 2 * hlocal)
-                        )
+                    hlocal = feature_size.getFeatureSizes(Xpt)
+                    hvals *= hlocal
+                    np.clip(hvals, 0.25 * hlocal, 2 * hlocal, out=hvals)
                 else:
-                    for i, hp in enumerate(hvals):
-                        hvals[i] = np.min(
-                            (np.max((hp * htarget, 0.25 * htarget)), 2 * htarget)
-                        )
+                    hvals *= htarget
+                    np.clip(hvals, 0.25 * htarget, 2 * htarget, out=hvals)
 
                 # Allocate the feature size object
                 hmax = 10.0
@@ -1389,19 +1410,17 @@ for k in range(steps):
                     x, y = np.meshgrid(
                         np.linspace(0, 2 * np.pi, 100), np.linspace(0, L, 100)
                     )
-                    z = np.zeros((100, 100))
-                    for j in range(100):
-                        for i in range(100):
-                            xpt = [R * np.cos(x[i, j]), R * np.sin(x[i, j]), y[i, j]]
-                            z[i, j] = feature_size.getFeatureSize(xpt)
+                    xpts = np.empty((100 * 100, 3))
+                    xpts[:, 0] = (R * np.cos(x)).ravel()
+                    xpts[:, 1] = (R * np.sin(x)).ravel()
+                    xpts[:, 2] = y.ravel()
+                    z = feature_size.getFeatureSizes(xpts).reshape(100, 100)
 
                     plt.contourf(x, y, z)
                     plt.show()
             else:
-                size = error.shape[0]
-                comm.gather(size, root=root)
-                comm.Gatherv(error, None)
-                comm.Gatherv(Xp.flatten(), None)
+                comm.Gatherv(error, None, root=root)
+                comm.Gatherv(Xp, None, root=root)
 
                 # Create a dummy feature size object...
                 feature_size = TMR.ConstElementSize(0.5 * htarget)
@@ -1422,30 +1441,23 @@ for k in range(steps):
             forest.setMeshOrder(order, TMR.UNIFORM_POINTS)
             forest.createTrees(depth)
         else:
-            # The refinement array
-            refine = np.zeros(len(error), dtype=np.intc)
-
-            # Determine the cutoff values
-            cutoff = bins[-1]
-            bin_sum = 0
-            for i in range(len(bins) + 1):
-                bin_sum += bins[i]
-                if bin_sum > 0.3 * ntotal:
-                    cutoff = bounds[i]
-                    break
-
-            log_cutoff = np.log(cutoff)
+            # Determine the cutoff value from the first bin where the
+            # cumulative count exceeds 30% of the elements
+            index = np.searchsorted(np.cumsum(bins), 0.3 * ntotal, side="right")
+            cutoff = bounds[min(index, len(bounds) - 1)]
 
             # Element target error is still too high. Adapt based solely
             # on decreasing the overall error
-            nrefine = 0
-            for i, err in enumerate(error):
-                # Compute the log of the error
-                logerr = np.log(err)
-
-                if logerr > log_cutoff:
-                    refine[i] = 1
-                    nrefine += 1
+            refine = (error > cutoff).astype(np.intc)
 
             # Refine the forest
             forest.refine(refine)
+
+# Wait for the remaining histogram data to be written
+if io_future is not None:
+    io_future.result()
+io_pool.shutdown(wait=True)
+
+log_fp.close()
+if case == "disk" and args.compute_solution_error:
+    sol_log_fp.close()
@@ -0,0 +1,53 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+
+# Import numpy
+import numpy as np
+cimport numpy as np
+
+# Ensure that numpy is initialized
+np.import_array()
+
+from cython.parallel cimport prange
+from libc.math cimport sin, cos, sqrt, exp, M_PI
+
+def cylinder_ks_sum(double alpha, double beta, double L, double R,
+                    double tcoef1, double tcoef2,
+                    double bcoef1, double bcoef2,
+                    double rho, double vm_max, int n):
+    '''
+    Compute the sum over the cells of an n x n grid of the four corner
+    values of exp(rho*(vm - vm_max)) for the top and bottom surfaces of
+    the cylinder without forming the grid
+    '''
+    cdef int i, j
+    cdef double hy = 2.0*M_PI*R/(n - 1)
+    cdef double sy, cy, s2, c2, val, row
+    cdef double ks_sum = 0.0
+
+    # The x-dependent factors are shared by every row of the grid
+    x = np.linspace(0.0, L, n)
+    cdef double[::1] sx = np.sin(beta*x)
+    cdef double[::1] cx = np.cos(beta*x)
+
+    for i in prange(n, nogil=True, schedule='static'):
+        sy = sin(alpha*i*hy)
+        cy = cos(alpha*i*hy)
+
+        # Each node is shared by 1, 2 or 4 cells
+        row = 0.0
+        for j in range(n):
+            s2 = (sy*sx[j])*(sy*sx[j])
+            c2 = (cy*cx[j])*(cy*cx[j])
+            val = exp(rho*(sqrt(tcoef1*s2 + tcoef2*c2) - vm_max)) + \
+                exp(rho*(sqrt(bcoef1*s2 + bcoef2*c2) - vm_max))
+            if j == 0 or j == n-1:
+                row = row + val
+            else:
+                row = row + 2.0*val
+
+        if i == 0 or i == n-1:
+            ks_sum += row
+        else:
+            ks_sum += 2.0*row
+
+    return ks_sum
@@ -0,0 +1,41 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+
+# Import numpy
+import numpy as np
+cimport numpy as np
+
+# Ensure that numpy is initialized
+np.import_array()
+
+from cython.parallel cimport prange
+from libc.math cimport cos, exp, pow, fabs
+
+def disk_theta_integrals(double[::1] theta, double[::1] x,
+                         double[::1] dphi, double[::1] glwts,
+                         double R, double rho, double pmax, int n,
+                         bint pnorm=False):
+    '''
+    Compute the radial integral of the ks or p-norm integrand of the
+    x-derivative of the disk solution at each of the angles theta
+    '''
+    cdef int i, j
+    cdef int ntheta = theta.shape[0]
+    cdef int npts = x.shape[0]
+    cdef double ct, acc
+    cdef double scale = R/(2.0*n)
+    cdef np.ndarray[double, ndim=1] result = np.zeros(ntheta)
+    cdef double[::1] res = result
+
+    for i in prange(ntheta, nogil=True, schedule='static'):
+        ct = cos(theta[i])
+
+        # Integrate over the radial direction
+        acc = 0.0
+        for j in range(npts):
+            if pnorm:
+                acc = acc + glwts[j % 6]*R*x[j]*pow(fabs(dphi[j]*ct)/pmax, rho)
+            else:
+                acc = acc + glwts[j % 6]*R*x[j]*exp(rho*(dphi[j]*ct - pmax))
+        res[i] = scale*acc
+
+    return result
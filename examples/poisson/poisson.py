@@ -5,38 +5,77 @@ from tacs import TACS, elements, functions
 import numpy as np
 import argparse
 import os
+from concurrent.futures import ThreadPoolExecutor
 import poisson_function
 
-glpts6 = [
-    -0.9324695142031520278123016,
-    -0.6612093864662645136613996,
-    -0.2386191860831969086305017,
-    0.2386191860831969086305017,
-    0.6612093864662645136613996,
-    0.9324695142031520278123016,
-]
-glwts6 = [
-    0.1713244923791703450402961,
-    0.3607615730481386075698335,
-    0.4679139345726910473898703,
-    0.4679139345726910473898703,
-    0.3607615730481386075698335,
-    0.1713244923791703450402961,
-]
+# The compiled disk kernel is optional, fall back to NumPy without it
+try:
+    import disk_kernel
+except ImportError:
+    disk_kernel = None
+
+glpts6 = np.array(
+    [
+        -0.9324695142031520278123016,
+        -0.6612093864662645136613996,
+        -0.2386191860831969086305017,
+        0.2386191860831969086305017,
+        0.6612093864662645136613996,
+        0.9324695142031520278123016,
+    ]
+)
+glwts6 = np.array(
+    [
+        0.1713244923791703450402961,
+        0.3607615730481386075698335,
+        0.4679139345726910473898703,
+        0.4679139345726910473898703,
+        0.3607615730481386075698335,
+        0.1713244923791703450402961,
+    ]
+)
 
 
 def get_quadrature_pts(m):
-    x = np.zeros(len(glpts6) * m)
-    for i, pt in enumerate(glpts6):
-        x[i::6] = np.linspace(0, 1 - 1.0 / m, m) + 0.5 * (1.0 + glpts6[i]) / m
-    return x
+    # The six Gauss points in each of the m intervals are stored
+    # contiguously, so that x[i::6] is the i-th point of every interval
+    x = np.linspace(0, 1 - 1.0 / m, m)[:, np.newaxis] + 0.5 * (1.0 + glpts6) / m
+    return x.ravel()
 
 
 def quadrature(integrand):
-    integral = 0.0
-    for i, wt in enumerate(glwts6):
-        integral += wt * np.sum(integrand[i::6])
-    return integral
+    return np.sum(np.dot(integrand.reshape(-1, 6), glwts6))
+
+
+def estrin(coef, x):
+    """
+    Evaluate the polynomial sum(coef[k] * x**k) on an array using
+    Estrin's scheme
+    """
+
+    # Combine the coefficients in pairs, c[k] + c[k + 1]*x
+    terms = []
+    for k in range(0, len(coef), 2):
+        if k + 1 < len(coef):
+            t = coef[k + 1] * x
+            t += coef[k]
+        else:
+            t = np.full_like(x, coef[k])
+        terms.append(t)
+
+    # Combine the pairs of terms with successive squares of x
+    xp = x
+    while len(terms) > 1:
+        xp = xp * xp
+        for k in range(1, len(terms), 2):
+            terms[k] *= xp
+            terms[k] += terms[k - 1]
+        if len(terms) % 2 == 1:
+            terms = terms[1::2] + [terms[-1]]
+        else:
+            terms = terms[1::2]
+
+    return terms[0]
 
 
 def poisson_evalf(x):
@@ -44,22 +83,61 @@ def poisson_evalf(x):
     return (3920.0 / 363) * (1.0 - (x[0] * x[0] + x[1] * x[1]) / R**2) ** 6
 
 
+# The disk solution scaled to r/R is a0*p(x**2), and its x-derivative
+# is a0*x*q(x**2), where p and q are the polynomials with these
+# coefficients in increasing order
+disk_coef = np.array(
+    [
+        363.0 / 3920,
+        -1.0 / 4,
+        3.0 / 8,
+        -5.0 / 12,
+        5.0 / 16,
+        -3.0 / 20,
+        1.0 / 24,
+        -1.0 / 196,
+    ]
+)
+disk_grad_coef = np.array(
+    [
+        -2.0 / 4,
+        12.0 / 8,
+        -30.0 / 12,
+        40.0 / 16,
+        -30.0 / 20,
+        12.0 / 24,
+        -14.0 / 196,
+    ]
+)
+
+
+def get_disk_grad_max():
+    """
+    Find the maximum magnitude of the x-derivative of the disk solution.
+    The extrema of x*q(x**2) occur at the roots of the degree-6
+    polynomial sum((2k + 1)*c[k]*u**k) in u = x**2, so only the unique
+    root with u in [0, 1] is needed.
+    """
+    a0 = 3920.0 / 363.0
+    coef = (2 * np.arange(len(disk_grad_coef)) + 1) * disk_grad_coef
+    for root in np.roots(coef[::-1]):
+        if root.real >= 0.0 and root.real <= 1.0 and root.imag == 0.0:
+            u = root.real
+            return np.fabs(a0 * np.sqrt(u) * np.polyval(disk_grad_coef[::-1], u))
+
+
+# The maximum only depends on constants, so compute it once
+disk_grad_max = get_disk_grad_max()
+
+
 def get_disk_aggregate(comm, functional, rho, R, n=1000):
     """Evaluate the KS functional on a disk"""
     a0 = 3920.0 / 363.0
     if functional == "ks" or functional == "pnorm":
         # Compute the solution scaled to r/R
         x = get_quadrature_pts(n)
-        phi = a0 * (
-            -(1.0 / 196) * x**14
-            + (1.0 / 24) * x**12
-            - (3.0 / 20) * x**10
-            + (5.0 / 16) * x**8
-            - (5.0 / 12) * x**6
-            + (3.0 / 8) * x**4
-            - (1.0 / 4) * x**2
-            + (363.0 / 3920)
-        )
+        phi = estrin(disk_coef, x * x)
+        phi *= a0
 
         if functional == "ks":
             ksmax = np.max(phi)
@@ -77,180 +155,176 @@ def get_disk_aggregate(comm, functional, rho, R, n=1000):
         x = get_quadrature_pts(n)
         theta = np.pi * get_quadrature_pts(m)
 
-        dphi = a0 * (
-            -(14.0 / 196) * x**13
-            + (12.0 / 24) * x**11
-            - (30.0 / 20) * x**9
-            + (40.0 / 16) * x**7
-            - (30.0 / 12) * x**5
-            + (12.0 / 8) * x**3
-            - (2.0 / 4) * x
-        )
-
-        poly = np.poly1d(
-            [
-                -a0 * 14 / 196,
-                0,
-                a0 * 12 / 24,
-                0,
-                -a0 * (30.0 / 20),
-                0,
-                a0 * (40.0 / 16),
-                0,
-                -a0 * (30.0 / 12),
-                0,
-                a0 * (12.0 / 8),
-                0,
-                -a0 * (2.0 / 4),
-                0,
-            ]
-        )
-
-        deriv = poly.deriv()
-        for root in deriv.roots:
-            if root.real >= 0.0 and root.real <= 1.0 and root.imag == 0.0:
-                pmax = np.fabs(poly(root).real)
-                break
+        dphi = estrin(disk_grad_coef, x * x)
+        dphi *= a0 * x
+        pmax = disk_grad_max
 
         # Set the start/end locations
-        step = len(theta) / comm.size
+        step = len(theta) // comm.size
         start = step * comm.rank
         end = step * (comm.rank + 1)
         if comm.rank == comm.size - 1:
             end = len(theta)
 
-        if functional == "ks_grad":
-            integrand1 = np.zeros(m)
-            for i, t in enumerate(theta[start:end]):
-                integrand = R * x * np.exp(rho * (dphi * np.cos(t) - pmax))
-                integrand1[i] = (R / (2 * n)) * quadrature(integrand)
+        # Each proc computes the radial integrals for its range of theta
+        integrand1 = np.zeros(len(theta))
+        if disk_kernel is not None:
+            integrand1[start:end] = disk_kernel.disk_theta_integrals(
+                theta[start:end],
+                x,
+                dphi,
+                glwts6,
+                R,
+                rho,
+                pmax,
+                n,
+                pnorm=(functional == "pnorm_grad"),
+            )
+        else:
+            # Fold the radial quadrature weights into a single vector
+            wts = (R / (2 * n)) * R * x * np.tile(glwts6, n)
+
+            # Evaluate the integrand over blocks of angles at once, sized
+            # so that each block of the integrand stays in cache
+            ct = np.cos(theta[start:end])
+            block = max(1, 2**17 // len(x))
+            for b in range(0, len(ct), block):
+                E = np.multiply.outer(ct[b : b + block], dphi)
+                if functional == "ks_grad":
+                    E -= pmax
+                    E *= rho
+                    np.exp(E, out=E)
+                else:
+                    np.fabs(E, out=E)
+                    E /= pmax
+                    np.power(E, rho, out=E)
+                integrand1[start + b : start + b + E.shape[0]] = np.dot(E, wts)
 
-            integrand1 = comm.allreduce(integrand1, op=MPI.SUM)
+        comm.Allreduce(MPI.IN_PLACE, integrand1, op=MPI.SUM)
+
+        if functional == "ks_grad":
             kssum = 2 * (np.pi / (2 * m)) * quadrature(integrand1)
             return pmax, pmax + np.log(kssum) / rho
         elif functional == "pnorm_grad":
-            integrand1 = np.zeros(m)
-            for i, t in enumerate(theta[start:end]):
-                integrand = R * x * np.power((np.fabs(dphi * np.cos(t)) / pmax), rho)
-                integrand1[i] = (R / (2 * n)) * quadrature(integrand)
-
-            integrand1 = comm.allreduce(integrand1, op=MPI.SUM)
             psum = 2 * (np.pi / (2 * m)) * quadrature(integrand1)
             return pmax, pmax * np.power(psum, 1.0 / rho)
 
 
+# The exponents of x[0] and x[1] in each term of the reconstruction
+# basis, ordered by total degree and then by decreasing power of x[0]
+recon_exponents = {
+    degree: np.array(
+        [(k - j, j) for k in range(degree + 1) for j in range(k + 1)], dtype=np.intc
+    ).T
+    for degree in (2, 3, 4, 5)
+}
+
+
 def recon_basis(degree, x):
     """
-    Get the quadratic shape functions centered about the point pt
+    Get the polynomial reconstruction basis of the given degree at the
+    point x, or at each row of an (npts, 2) array of points
     """
 
-    if degree == 2:
-        N = np.array([1.0, x[0], x[1], x[0] * x[0], x[0] * x[1], x[1] * x[1]])
-    elif degree == 3:
-        N = np.array(
-            [
-                1.0,
-                x[0],
-                x[1],
-                x[0] * x[0],
-                x[0] * x[1],
-                x[1] * x[1],
-                x[0] * x[0] * x[0],
-                x[0] * x[0] * x[1],
-                x[0] * x[1] * x[1],
-                x[1] * x[1] * x[1],
-            ]
-        )
-    elif degree == 4:
-        N = np.array(
-            [
-                1.0,
-                x[0],
-                x[1],
-                x[0] * x[0],
-                x[0] * x[1],
-                x[1] * x[1],
-                x[0] * x[0] * x[0],
-                x[0] * x[0] * x[1],
-                x[0] * x[1] * x[1],
-                x[1] * x[1] * x[1],
-                x[0] * x[0] * x[0] * x[0],
-                x[0] * x[0] * x[0] * x[1],
-                x[0] * x[0] * x[1] * x[1],
-                x[0] * x[1] * x[1] * x[1],
-                x[1] * x[1] * x[1] * x[1],
-            ]
-        )
-    elif degree == 5:
-        N = np.array(
-            [
-                1.0,
-                x[0],
-                x[1],
-                x[0] * x[0],
-                x[0] * x[1],
-                x[1] * x[1],
-                x[0] * x[0] * x[0],
-                x[0] * x[0] * x[1],
-                x[0] * x[1] * x[1],
-                x[1] * x[1] * x[1],
-                x[0] * x[0] * x[0] * x[0],
-                x[0] * x[0] * x[0] * x[1],
-                x[0] * x[0] * x[1] * x[1],
-                x[0] * x[1] * x[1] * x[1],
-                x[1] * x[1] * x[1] * x[1],
-                x[0] * x[0] * x[0] * x[0] * x[0],
-                x[0] * x[0] * x[0] * x[0] * x[1],
-                x[0] * x[0] * x[0] * x[1] * x[1],
-                x[0] * x[0] * x[1] * x[1] * x[1],
-                x[0] * x[1] * x[1] * x[1] * x[1],
-                x[1] * x[1] * x[1] * x[1] * x[1],
-            ]
-        )
+    x = np.asarray(x, dtype=float)
+
+    # Compute all the powers of each coordinate up to the degree
+    px = np.empty(x.shape[:-1] + (degree + 1,))
+    py = np.empty(x.shape[:-1] + (degree + 1,))
+    px[..., 0] = 1.0
+    py[..., 0] = 1.0
+    px[..., 1:] = x[..., 0, np.newaxis]
+    py[..., 1:] = x[..., 1, np.newaxis]
+    np.multiply.accumulate(px, axis=-1, out=px)
+    np.multiply.accumulate(py, axis=-1, out=py)
+
+    ix, iy = recon_exponents[degree]
+    N = px[..., ix] * py[..., iy]
 
     return N
 
 
-def elem_recon(degree, conn, Xpts, uvals, elem_list, max_dist=1.0):
-    # Get a unique list of the nodes in the list
-    var = []
-    for elem in elem_list:
-        var.extend(conn[elem])
+def compute_elem_to_elem(conn):
+    """
+    Compute the element->element connectivity (elements sharing at least
+    one node) as CSR arrays (ptr, elems)
+    """
 
-    # Get a unique list of values
-    var = list(set(var))
+    nelems, nodes_per_elem = conn.shape
+    flat = conn.ravel()
+    elems = np.repeat(np.arange(nelems), nodes_per_elem)
 
-    # Set up the least-squares fit
-    pt = np.average(Xpts[var, :], axis=0)[:2]
-    dist = np.sqrt(np.sum((Xpts[var, :2] - pt) ** 2, axis=1))
+    # Create the node->element connectivity by sorting on the node number
+    perm = np.argsort(flat, kind="stable")
+    node_elems = elems[perm]
+    node_count = np.bincount(flat)
+    node_ptr = np.zeros(len(node_count) + 1, dtype=np.intp)
+    np.cumsum(node_count, out=node_ptr[1:])
 
-    # Loop over the adjacent nodes and fit them
-    dim = 6
-    if degree == 3:
-        dim = 10
-    elif degree == 4:
-        dim = 15
-    elif degree == 5:
-        dim = 21
-    A = np.zeros((len(var), dim))
-    b = np.zeros(len(var))
+    # Pair every (element, node) entry with all the elements at that node
+    count = node_count[flat]
+    offset = np.arange(np.sum(count)) - np.repeat(np.cumsum(count) - count, count)
+    rows = np.repeat(elems, count)
+    cols = node_elems[np.repeat(node_ptr[flat], count) + offset]
 
-    for i, v in enumerate(var):
-        w = np.exp(-2 * dist[i] / max_dist)
+    # Remove the duplicates - the unique pairs come out sorted by row
+    pairs = np.unique(rows * nelems + cols)
+    rows = pairs // nelems
+    cols = pairs % nelems
 
-        # Compute the basis at the provided point
-        b[i] = w * uvals[v]
+    ptr = np.zeros(nelems + 1, dtype=np.intp)
+    np.cumsum(np.bincount(rows, minlength=nelems), out=ptr[1:])
 
-        x = Xpts[v, :2]
-        A[i, :] = w * recon_basis(degree, (x - pt) / max_dist)
+    return ptr, cols
 
-    # Fit the basis
-    vals, res, rank, s = np.linalg.lstsq(A, b, rcond=-1)
+
+def elem_recon(degree, Xpts, uvals, var, mask, max_dist=1.0):
+    """
+    Compute the weighted least-squares fit for a block of element
+    patches. Each row of var contains the nodes in one patch, padded
+    to the same length where mask is False.
+    """
+
+    # Set up the least-squares fit about the center of each patch
+    nvar = np.sum(mask, axis=1)
+    X = Xpts[var, :2]
+    pt = np.sum(X * mask[:, :, np.newaxis], axis=1) / nvar[:, np.newaxis]
+    X -= pt[:, np.newaxis, :]
+    dist = np.sqrt(np.sum(X**2, axis=2))
+
+    # The padded entries get a zero weight and drop out of the fit
+    w = np.exp(-2 * dist / max_dist) * mask
+    A = w[:, :, np.newaxis] * recon_basis(degree, X / max_dist)
+    b = w * uvals[var]
+
+    # Fit the basis for all the patches at once with a Cholesky
+    # factorization of the normal equations. Patches with fewer nodes
+    # than basis functions are rank deficient, and patches where the
+    # Cholesky diagonal shows an ill-conditioned Gram matrix lose
+    # accuracy, so fit those, or all of the patches if any of the
+    # factorizations fail, with least squares.
+    dim = A.shape[2]
+    vals = np.zeros((A.shape[0], dim))
+    full = nvar >= dim
+    try:
+        ATA = np.matmul(A[full].transpose(0, 2, 1), A[full])
+        ATb = np.einsum("ekd,ek->ed", A[full], b[full])
+        L = np.linalg.cholesky(ATA)
+        y = np.linalg.solve(L, ATb[:, :, np.newaxis])
+        vals[full] = np.linalg.solve(L.transpose(0, 2, 1), y)[:, :, 0]
+
+        d = np.diagonal(L, axis1=1, axis2=2)
+        full[full] = (d.max(axis=1) / d.min(axis=1)) ** 2 <= 1e8
+    except np.linalg.LinAlgError:
+        full[:] = False
+
+    for i in np.nonzero(~full)[0]:
+        vals[i] = np.linalg.lstsq(A[i], b[i], rcond=-1)[0]
 
     return vals, pt
 
 
-def computeRecon(degree, conn, Xpts, uvals, conn_refine, Xpts_refine):
+def computeRecon(degree, conn, Xpts, uvals, conn_refine, Xpts_refine, block=1024):
     """
     Compute the planar reconstruction over the given mesh
     """
@@ -258,45 +332,57 @@ def computeRecon(degree, conn, Xpts, uvals, conn_refine, Xpts_refine):
     # Compute the element->element connectivity
     nelems = conn.shape[0]
 
-    # Create a node->element dictionary
-    node_to_elems = {}
-    for i in range(nelems):
-        for node in conn[i, :]:
-            if node in node_to_elems:
-                node_to_elems[node][i] = True
-            else:
-                node_to_elems[node] = {i: True}
-
-    # Now create an elements to elements list
-    elem_to_elem = []
-    for i in range(nelems):
-        elems = {}
-        for node in conn[i, :]:
-            for elem in node_to_elems[node]:
-                elems[elem] = True
-        elem_to_elem.append(elems.keys())
-
-    # Get the refined shape
-    uvals_refine = np.zeros(Xpts_refine.shape[0])
-    count = np.zeros(Xpts_refine.shape[0])
+    # Compute the element->element connectivity in CSR format
+    elem_ptr, elem_to_elem = compute_elem_to_elem(conn)
+
+    # Get the unique, sorted list of the nodes in the patch of each
+    # element in CSR format
+    nnodes = np.max(conn) + 1
+    rows = np.repeat(np.arange(nelems), np.diff(elem_ptr))
+    pairs = np.unique(rows[:, np.newaxis] * nnodes + conn[elem_to_elem])
+    patch_elems = pairs // nnodes
+    patch_nodes = pairs % nnodes
+    patch_ptr = np.zeros(nelems + 1, dtype=np.intp)
+    np.cumsum(np.bincount(patch_elems, minlength=nelems), out=patch_ptr[1:])
+
+    # Get the refined shape and the number of elements sharing each
+    # refined node
+    nrefine = Xpts_refine.shape[0]
+    uvals_refine = np.zeros(nrefine)
+    count = np.bincount(conn_refine[:nelems].ravel(), minlength=nrefine)
 
     # Compute the average element distance
     max_dist = 2.0 * np.average(
         np.sqrt(np.sum((Xpts[conn[:, 0]] - Xpts[conn[:, -1]]) ** 2, axis=1))
     )
 
-    for elem in range(nelems):
-        # Get the list of elements
-        elem_list = elem_to_elem[elem]
+    # Reconstruct the solution over blocks of elements at a time
+    for start in range(0, nelems, block):
+        end = min(start + block, nelems)
+
+        # Pad the patches in this block to the same length
+        lo = patch_ptr[start]
+        hi = patch_ptr[end]
+        npatch = np.max(np.diff(patch_ptr[start : end + 1]))
+        row = patch_elems[lo:hi]
+        col = np.arange(lo, hi) - patch_ptr[row]
+        var = np.zeros((end - start, npatch), dtype=int)
+        mask = np.zeros((end - start, npatch), dtype=bool)
+        var[row - start, col] = patch_nodes[lo:hi]
+        mask[row - start, col] = True
 
         # Get the reconstructed values
-        vals, pt = elem_recon(degree, conn, Xpts, uvals, elem_list, max_dist=max_dist)
-
-        # Compute the refined contributions to each element
-        for node in conn_refine[elem, :]:
-            N = recon_basis(degree, (Xpts_refine[node, :2] - pt) / max_dist)
-            uvals_refine[node] += np.dot(vals, N)
-            count[node] += 1.0
+        vals, pt = elem_recon(degree, Xpts, uvals, var, mask, max_dist=max_dist)
+
+        # Compute the refined contributions to each element at once
+        nodes = conn_refine[start:end, :]
+        upts = (Xpts_refine[nodes, :2] - pt[:, np.newaxis, :]) / max_dist
+        N = recon_basis(degree, upts)
+        uvals_refine += np.bincount(
+            nodes.ravel(),
+            weights=np.einsum("end,ed->en", N, vals).ravel(),
+            minlength=nrefine,
+        )
 
     # Average the values
     uvals_refine /= count
@@ -592,12 +678,33 @@ if args.remesh_domain:
         descript += "_%g" % (args.element_count_target)
 
 # Create the log file and write out the header
-log_fp = open("results/%s.dat" % (descript), "w")
+log_fp = open("results/%s.dat" % (descript), "w", buffering=1)
 s = "Variables = iter, nelems, nnodes, fval, fcorr, abs_err, adjoint_corr, "
 s += "exact, fval_error, fval_corr_error, "
 s += "fval_effectivity, indicator_effectivity\n"
 log_fp.write(s)
 
+# The format of each line of the log file. The log file is line
+# buffered, so each row is written out without an explicit flush.
+log_fmt = "%6d %6d %6d %20.15e %20.15e %20.15e %20.15e "
+log_fmt += "%20.15e %20.15e %20.15e %20.15e %20.15e\n"
+
+# The bounds of the error histogram bins in descending order, an
+# ascending copy for the bin search and the bin counts, which are reused
+# and reduced in place at every step
+low = -25
+high = 4
+bins_per_decade = 10
+nbins = bins_per_decade * (high - low)
+bounds = 10 ** np.linspace(high, low, nbins + 1)
+asc_bounds = np.ascontiguousarray(bounds[::-1])
+bins = np.zeros(nbins + 2, dtype=np.intc)
+
+# Write the histogram data on a background thread. The pending write
+# is checked before the next one starts so that errors are raised.
+io_pool = ThreadPoolExecutor(max_workers=1)
+io_future = None
+
 # Set the feature size object
 feature_size = None
 
@@ -924,38 +1031,37 @@ for k in range(steps):
     f5_refine = TACS.ToFH5(assembler_refined, TACS.PY_POISSON_2D_ELEMENT, flag)
     f5_refine.writeToFile("results/%s_solution_refined%02d.f5" % (descript, k))
 
-    # Compute the refinement from the error estimate
-    low = -25
-    high = 4
-    bins_per_decade = 10
-    nbins = bins_per_decade * (high - low)
-    bounds = 10 ** np.linspace(high, low, nbins + 1)
-    bins = np.zeros(nbins + 2, dtype=np.int)
+    # Sum the number of elements, the first two moments of log(error)
+    # and the number of nodes across all procs
+    log_error = np.log(error)
+    sums = np.array(
+        [
+            assembler.getNumElements(),
+            np.sum(log_error),
+            np.dot(log_error, log_error),
+            assembler.getNumOwnedNodes(),
+        ],
+        dtype=np.float64,
+    )
+    comm.Allreduce(MPI.IN_PLACE, sums, op=MPI.SUM)
+    ntotal = int(sums[0])
+    nnodes = int(sums[3])
 
     # Compute the mean and standard deviations of the log(error)
-    ntotal = comm.allreduce(assembler.getNumElements(), op=MPI.SUM)
-    mean = comm.allreduce(np.sum(np.log(error)), op=MPI.SUM)
-    mean /= ntotal
-
-    # Compute the standard deviation
-    stddev = comm.allreduce(np.sum((np.log(error) - mean) ** 2), op=MPI.SUM)
-    stddev = np.sqrt(stddev / (ntotal - 1))
-
-    # Get the total number of nodes
-    nnodes = comm.allreduce(assembler.getNumOwnedNodes(), op=MPI.SUM)
+    mean = sums[1] / ntotal
+    stddev = np.sqrt(max(0.0, sums[2] - ntotal * mean**2) / (ntotal - 1))
 
     # Compute the error from the exact solution
-    fval_error = np.fabs(exact_functional - fval)
-    fval_corr_error = np.fabs(exact_functional - fval_corr)
+    fval_diff = exact_functional - fval
+    fval_error = abs(fval_diff)
+    fval_corr_error = abs(exact_functional - fval_corr)
 
-    fval_effectivity = (fval_corr - fval) / (exact_functional - fval)
-    indicator_effectivity = err_est / np.fabs(exact_functional - fval)
+    fval_effectivity = (fval_corr - fval) / fval_diff
+    indicator_effectivity = err_est / fval_error
 
     # Write the log data to a file
-    s = "%6d %6d %6d %20.15e %20.15e %20.15e %20.15e "
-    s += "%20.15e %20.15e %20.15e %20.15e %20.15e\n"
     log_fp.write(
-        s
+        log_fmt
         % (
             k,
             ntotal,
@@ -971,21 +1077,17 @@ for k in range(steps):
             indicator_effectivity,
         )
     )
-    log_fp.flush()
-
-    # Compute the bins
-    for i in range(len(error)):
-        if error[i] > bounds[0]:
-            bins[0] += 1
-        elif error[i] < bounds[-1]:
-            bins[-1] += 1
-        else:
-            for j in range(len(bounds) - 1):
-                if error[i] <= bounds[j] and error[i] > bounds[j + 1]:
-                    bins[j + 1] += 1
+
+    # Compute the bins. The bounds are in descending order so that bins[0]
+    # counts errors above bounds[0], bins[j + 1] counts the errors in
+    # (bounds[j + 1], bounds[j]] and bins[-1] counts errors below bounds[-1].
+    # The ascending bounds are known to be sorted, so binary search them
+    # directly rather than through np.digitize.
+    index = nbins + 1 - np.searchsorted(asc_bounds, error, side="left")
+    bins[:] = np.bincount(index, minlength=nbins + 2)
 
     # Compute the number of bins
-    bins = comm.allreduce(bins, MPI.SUM)
+    comm.Allreduce(MPI.IN_PLACE, bins, op=MPI.SUM)
 
     # Compute the sum of the bins
     total = np.sum(bins)
@@ -998,14 +1100,15 @@ for k in range(steps):
         print("mean      = ", mean)
         print("stddev    = ", stddev)
 
-        # Set the data
-        data = np.zeros((nbins, 4))
-        for i in range(nbins - 1, -1, -1):
-            data[i, 0] = bounds[i]
-            data[i, 1] = bounds[i + 1]
-            data[i, 2] = bins[i + 1]
-            data[i, 3] = 100.0 * bins[i + 1] / total
-        np.savetxt("results/%s_data%d.txt" % (descript, k), data)
+        # Set the data and write it out in the background
+        data = np.column_stack(
+            (bounds[:-1], bounds[1:], bins[1:-1], 100.0 * bins[1:-1] / total)
+        )
+        if io_future is not None:
+            io_future.result()
+        io_future = io_pool.submit(
+            np.savetxt, "results/%s_data%d.txt" % (descript, k), data
+        )
 
     # Print out the error estimate
     assembler.setDesignVars(error)
@@ -1025,13 +1128,13 @@ for k in range(steps):
             nelems = assembler.getNumElements()
 
             # Allocate the positions
-            Xp = np.zeros((nelems, 3))
+            Xp = np.empty((nelems, 3))
             for i in range(nelems):
                 # Get the information about the given element
                 elem, Xpt, vrs, dvars, ddvars = assembler.getElementData(i)
 
                 # Get the approximate element centroid
-                Xp[i, :] = np.average(Xpt.reshape((-1, 3)), axis=0)
+                Xpt.reshape(-1, 3).mean(axis=0, out=Xp[i])
 
             # Prepare to collect things to the root processor (only
             # one where it is required)
@@ -1041,13 +1144,17 @@ for k in range(steps):
             if comm.rank == root:
                 size = error.shape[0]
                 count = comm.gather(size, root=root)
-                count = np.array(count, dtype=np.int)
+                count = np.asarray(count, dtype=np.intc)
                 ntotal = np.sum(count)
 
+                # Gather the errors and the centroids concurrently
                 errors = np.zeros(np.sum(count))
                 Xpt = np.zeros(3 * np.sum(count))
-                comm.Gatherv(error, [errors, count])
-                comm.Gatherv(Xp.flatten(), [Xpt, 3 * count])
+                reqs = [
+                    comm.Igatherv(error, [errors, count], root=root),
+                    comm.Igatherv(Xp, [Xpt, 3 * count], root=root),
+                ]
+                MPI.Request.Waitall(reqs)
 
                 # Reshape the point array
                 Xpt = Xpt.reshape(-1, 3)
@@ -1060,8 +1167,10 @@ for k in range(steps):
                 # Dimension of the problem
                 d = 2.0
 
-                # Set the exponent
-                exponent = d / (d + s)
+                # Sum errors**(d/(d + s)) directly so that zero errors add
+                # nothing, rather than forming it from the element scale
+                # errors**(-1/(d + s)), which is infinite for zero errors
+                esum = np.sum(np.power(errors, d / (d + s)))
 
                 # Compute the target error as a fixed fraction of the
                 # error estimate. This will result in the size of the
@@ -1077,26 +1186,22 @@ for k in range(steps):
                 if args.remesh_strategy == "fixed_mesh":
                     # Compute the constant for element count
                     cval = (element_count_target) ** (-1.0 / d)
-                    cval *= (np.sum(errors ** (exponent))) ** (1.0 / d)
+                    cval *= esum ** (1.0 / d)
                 else:
                     # Compute the constant for target error
-                    cval = (err_target / np.sum(errors ** (exponent))) ** (1.0 / s)
+                    cval = (err_target / esum) ** (1.0 / s)
 
                 # Compute the element-wise target error
-                hvals = cval * errors ** (-(1.0 / (d + s)))
+                hvals = cval * np.power(errors, -1.0 / (d + s))
 
                 # Set the values of
                 if feature_size is not None:
-                    for i, hp in enumerate(hvals):
-                        hlocal = feature_size.getFeatureSize(Xpt[i, :])
-                        hvals[i] = np.min(
-                            (np.max((hp * hlocal, 0.25 * hlocal)), 2 * hlocal)
-                        )
+                    hlocal = feature_size.getFeatureSizes(Xpt)
+                    hvals *= hlocal
+                    np.clip(hvals, 0.25 * hlocal, 2 * hlocal, out=hvals)
                 else:
-                    for i, hp in enumerate(hvals):
-                        hvals[i] = np.min(
-                            (np.max((hp * htarget, 0.25 * htarget)), 2 * htarget)
-                        )
+                    hvals *= htarget
+                    np.clip(hvals, 0.25 * htarget, 2 * htarget, out=hvals)
 
                 # Allocate the feature size object
                 hmax = 10.0
@@ -1107,8 +1212,11 @@ for k in range(steps):
             else:
                 size = error.shape[0]
                 comm.gather(size, root=root)
-                comm.Gatherv(error, None)
-                comm.Gatherv(Xp.flatten(), None)
+                reqs = [
+                    comm.Igatherv(error, None, root=root),
+                    comm.Igatherv(Xp, None, root=root),
+                ]
+                MPI.Request.Waitall(reqs)
 
                 # Create a dummy feature size object...
                 feature_size = TMR.ConstElementSize(0.5 * htarget)
@@ -1129,32 +1237,24 @@ for k in range(steps):
             forest.setMeshOrder(order, TMR.UNIFORM_POINTS)
             forest.createTrees(depth)
         else:
-            # Allocate the refinement array
-            refine = np.zeros(len(error), dtype=np.intc)
-
-            # Determine the cutoff values
-            cutoff = bins[-1]
-            bin_sum = 0
-            for i in range(len(bins) + 1):
-                bin_sum += bins[i]
-                if bin_sum > 0.15 * ntotal:
-                    cutoff = bounds[i + 1]
-                    break
-
-            log_cutoff = np.log(cutoff)
+            # Determine the cutoff value from the lower bound of the first
+            # bin where the cumulative count exceeds 15% of the elements
+            index = np.searchsorted(np.cumsum(bins), 0.15 * ntotal, side="right")
+            cutoff = bounds[min(index + 1, len(bounds) - 1)]
 
             # Element target error is still too high. Adapt based solely
             # on decreasing the overall error
-            nrefine = 0
-            for i, err in enumerate(error):
-                # Compute the log of the error
-                logerr = np.log(err)
-
-                if logerr > log_cutoff:
-                    refine[i] = 1
-                    nrefine += 1
+            refine = (error > cutoff).astype(np.intc)
 
             # Refine the forest
             forest.refine(refine)
             forest.balance(1)
             forest.repartition()
+
+# Wait for the remaining histogram data to be written
+if io_future is not None:
+    io_future.result()
+io_pool.shutdown(wait=True)
+
+# Close the log file
+log_fp.close()
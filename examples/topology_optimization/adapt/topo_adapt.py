@@ -11,119 +11,121 @@ import topo as const_topo
 # Import pyoptsparse
 from pyoptsparse import Optimization, OPT
 
+# The exponents of x[0] and x[1] in each term of the reconstruction
+# basis, ordered by total degree and then by decreasing power of x[0]
+recon_exponents = {
+    degree: np.array(
+        [(k - j, j) for k in range(degree + 1) for j in range(k + 1)], dtype=np.intc
+    ).T
+    for degree in (2, 3, 4, 5)
+}
+
 
 def recon_basis(degree, x):
     """
-    Get the quadratic shape functions centered about the point pt
+    Get the polynomial reconstruction basis of the given degree at the
+    point x, or at each row of an (npts, 2) array of points
     """
 
-    if degree == 2:
-        N = np.array([1.0, x[0], x[1], x[0] * x[0], x[0] * x[1], x[1] * x[1]])
-    elif degree == 3:
-        N = np.array(
-            [
-                1.0,
-                x[0],
-                x[1],
-                x[0] * x[0],
-                x[0] * x[1],
-                x[1] * x[1],
-                x[0] * x[0] * x[0],
-                x[0] * x[0] * x[1],
-                x[0] * x[1] * x[1],
-                x[1] * x[1] * x[1],
-            ]
-        )
-    elif degree == 4:
-        N = np.array(
-            [
-                1.0,
-                x[0],
-                x[1],
-                x[0] * x[0],
-                x[0] * x[1],
-                x[1] * x[1],
-                x[0] * x[0] * x[0],
-                x[0] * x[0] * x[1],
-                x[0] * x[1] * x[1],
-                x[1] * x[1] * x[1],
-                x[0] * x[0] * x[0] * x[0],
-                x[0] * x[0] * x[0] * x[1],
-                x[0] * x[0] * x[1] * x[1],
-                x[0] * x[1] * x[1] * x[1],
-                x[1] * x[1] * x[1] * x[1],
-            ]
-        )
-    elif degree == 5:
-        N = np.array(
-            [
-                1.0,
-                x[0],
-                x[1],
-                x[0] * x[0],
-                x[0] * x[1],
-                x[1] * x[1],
-                x[0] * x[0] * x[0],
-                x[0] * x[0] * x[1],
-                x[0] * x[1] * x[1],
-                x[1] * x[1] * x[1],
-                x[0] * x[0] * x[0] * x[0],
-                x[0] * x[0] * x[0] * x[1],
-                x[0] * x[0] * x[1] * x[1],
-                x[0] * x[1] * x[1] * x[1],
-                x[1] * x[1] * x[1] * x[1],
-                x[0] * x[0] * x[0] * x[0] * x[0],
-                x[0] * x[0] * x[0] * x[0] * x[1],
-                x[0] * x[0] * x[0] * x[1] * x[1],
-                x[0] * x[0] * x[1] * x[1] * x[1],
-                x[0] * x[1] * x[1] * x[1] * x[1],
-                x[1] * x[1] * x[1] * x[1] * x[1],
-            ]
-        )
+    x = np.asarray(x, dtype=float)
+
+    # Compute all the powers of each coordinate up to the degree
+    px = np.empty(x.shape[:-1] + (degree + 1,))
+    py = np.empty(x.shape[:-1] + (degree + 1,))
+    px[..., 0] = 1.0
+    py[..., 0] = 1.0
+    px[..., 1:] = x[..., 0, np.newaxis]
+    py[..., 1:] = x[..., 1, np.newaxis]
+    np.multiply.accumulate(px, axis=-1, out=px)
+    np.multiply.accumulate(py, axis=-1, out=py)
+
+    ix, iy = recon_exponents[degree]
+    N = px[..., ix] * py[..., iy]
 
     return N
 
 
-def elem_recon(degree, conn, Xpts, uvals, elem_list, max_dist=1.0):
-    # Get a unique list of the nodes in the list
-    var = []
-    for elem in elem_list:
-        var.extend(conn[elem])
+def compute_elem_to_elem(conn):
+    """
+    Compute the element->element connectivity (elements sharing at least
+    one node) as CSR arrays (ptr, elems)
+    """
+
+    nelems, nodes_per_elem = conn.shape
+    flat = conn.ravel()
+    elems = np.repeat(np.arange(nelems), nodes_per_elem)
+
+    # Create the node->element connectivity by sorting on the node number
+    perm = np.argsort(flat, kind="stable")
+    node_elems = elems[perm]
+    node_count = np.bincount(flat)
+    node_ptr = np.zeros(len(node_count) + 1, dtype=np.intp)
+    np.cumsum(node_count, out=node_ptr[1:])
 
-    # Get a unique list of values
-    var = list(set(var))
+    # Pair every (element, node) entry with all the elements at that node
+    count = node_count[flat]
+    offset = np.arange(np.sum(count)) - np.repeat(np.cumsum(count) - count, count)
+    rows = np.repeat(elems, count)
+    cols = node_elems[np.repeat(node_ptr[flat], count) + offset]
 
-    # Set up the least-squares fit
-    pt = np.average(Xpts[var, :], axis=0)[:2]
-    dist = np.sqrt(np.sum((Xpts[var, :2] - pt) ** 2, axis=1))
+    # Remove the duplicates - the unique pairs come out sorted by row
+    pairs = np.unique(rows * nelems + cols)
+    rows = pairs // nelems
+    cols = pairs % nelems
 
-    # Loop over the adjacent nodes and fit them
-    dim = 6
-    if degree == 3:
-        dim = 10
-    elif degree == 4:
-        dim = 15
-    elif degree == 5:
-        dim = 21
-    A = np.zeros((len(var), dim))
-    b = np.zeros(len(var))
+    ptr = np.zeros(nelems + 1, dtype=np.intp)
+    np.cumsum(np.bincount(rows, minlength=nelems), out=ptr[1:])
 
-    for i, v in enumerate(var):
-        w = np.exp(-2 * dist[i] / max_dist)
+    return ptr, cols
 
-        # Compute the basis at the provided point
-        b[i] = w * uvals[v]
 
-        x = Xpts[v, :2]
-        A[i, :] = w * recon_basis(degree, (x - pt) / max_dist)
+def elem_recon(degree, Xpts, uvals, var, mask, max_dist=1.0):
+    """
+    Compute the weighted least-squares fit for a block of element
+    patches. Each row of var contains the nodes in one patch, padded
+    to the same length where mask is False.
+    """
 
-    # Fit the basis
-    vals, res, rank, s = np.linalg.lstsq(A, b, rcond=-1)
+    # Set up the least-squares fit about the center of each patch
+    nvar = np.sum(mask, axis=1)
+    X = Xpts[var, :2]
+    pt = np.sum(X * mask[:, :, np.newaxis], axis=1) / nvar[:, np.newaxis]
+    X -= pt[:, np.newaxis, :]
+    dist = np.sqrt(np.sum(X**2, axis=2))
+
+    # The padded entries get a zero weight and drop out of the fit
+    w = np.exp(-2 * dist / max_dist) * mask
+    A = w[:, :, np.newaxis] * recon_basis(degree, X / max_dist)
+    b = w * uvals[var]
+
+    # Fit the basis for all the patches at once with a Cholesky
+    # factorization of the normal equations. Patches with fewer nodes
+    # than basis functions are rank deficient, and patches where the
+    # Cholesky diagonal shows an ill-conditioned Gram matrix lose
+    # accuracy, so fit those, or all of the patches if any of the
+    # factorizations fail, with least squares.
+    dim = A.shape[2]
+    vals = np.zeros((A.shape[0], dim))
+    full = nvar >= dim
+    try:
+        ATA = np.matmul(A[full].transpose(0, 2, 1), A[full])
+        ATb = np.einsum("ekd,ek->ed", A[full], b[full])
+        L = np.linalg.cholesky(ATA)
+        y = np.linalg.solve(L, ATb[:, :, np.newaxis])
+        vals[full] = np.linalg.solve(L.transpose(0, 2, 1), y)[:, :, 0]
+
+        d = np.diagonal(L, axis1=1, axis2=2)
+        full[full] = (d.max(axis=1) / d.min(axis=1)) ** 2 <= 1e8
+    except np.linalg.LinAlgError:
+        full[:] = False
+
+    for i in np.nonzero(~full)[0]:
+        vals[i] = np.linalg.lstsq(A[i], b[i], rcond=-1)[0]
 
     return vals, pt
 
 
-def computeRecon(degree, conn, Xpts, uvals, conn_refine, Xpts_refine):
+def computeRecon(degree, conn, Xpts, uvals, conn_refine, Xpts_refine, block=1024):
     """
     Compute the planar reconstruction over the given mesh
     """
@@ -131,45 +133,57 @@ def computeRecon(degree, conn, Xpts, uvals, conn_refine, Xpts_refine):
     # Compute the element->element connectivity
     nelems = conn.shape[0]
 
-    # Create a node->element dictionary
-    node_to_elems = {}
-    for i in range(nelems):
-        for node in conn[i, :]:
-            if node in node_to_elems:
-                node_to_elems[node][i] = True
-            else:
-                node_to_elems[node] = {i: True}
-
-    # Now create an elements to elements list
-    elem_to_elem = []
-    for i in range(nelems):
-        elems = {}
-        for node in conn[i, :]:
-            for elem in node_to_elems[node]:
-                elems[elem] = True
-        elem_to_elem.append(elems.keys())
-
-    # Get the refined shape
-    uvals_refine = np.zeros(Xpts_refine.shape[0])
-    count = np.zeros(Xpts_refine.shape[0])
+    # Compute the element->element connectivity in CSR format
+    elem_ptr, elem_to_elem = compute_elem_to_elem(conn)
+
+    # Get the unique, sorted list of the nodes in the patch of each
+    # element in CSR format
+    nnodes = np.max(conn) + 1
+    rows = np.repeat(np.arange(nelems), np.diff(elem_ptr))
+    pairs = np.unique(rows[:, np.newaxis] * nnodes + conn[elem_to_elem])
+    patch_elems = pairs // nnodes
+    patch_nodes = pairs % nnodes
+    patch_ptr = np.zeros(nelems + 1, dtype=np.intp)
+    np.cumsum(np.bincount(patch_elems, minlength=nelems), out=patch_ptr[1:])
+
+    # Get the refined shape and the number of elements sharing each
+    # refined node
+    nrefine = Xpts_refine.shape[0]
+    uvals_refine = np.zeros(nrefine)
+    count = np.bincount(conn_refine[:nelems].ravel(), minlength=nrefine)
 
     # Compute the average element distance
     max_dist = 2.0 * np.average(
         np.sqrt(np.sum((Xpts[conn[:, 0]] - Xpts[conn[:, -1]]) ** 2, axis=1))
     )
 
-    for elem in range(nelems):
-        # Get the list of elements
-        elem_list = elem_to_elem[elem]
+    # Reconstruct the solution over blocks of elements at a time
+    for start in range(0, nelems, block):
+        end = min(start + block, nelems)
+
+        # Pad the patches in this block to the same length
+        lo = patch_ptr[start]
+        hi = patch_ptr[end]
+        npatch = np.max(np.diff(patch_ptr[start : end + 1]))
+        row = patch_elems[lo:hi]
+        col = np.arange(lo, hi) - patch_ptr[row]
+        var = np.zeros((end - start, npatch), dtype=int)
+        mask = np.zeros((end - start, npatch), dtype=bool)
+        var[row - start, col] = patch_nodes[lo:hi]
+        mask[row - start, col] = True
 
         # Get the reconstructed values
-        vals, pt = elem_recon(degree, conn, Xpts, uvals, elem_list, max_dist=max_dist)
-
-        # Compute the refined contributions to each element
-        for node in conn_refine[elem, :]:
-            N = recon_basis(degree, (Xpts_refine[node, :2] - pt) / max_dist)
-            uvals_refine[node] += np.dot(vals, N)
-            count[node] += 1.0
+        vals, pt = elem_recon(degree, Xpts, uvals, var, mask, max_dist=max_dist)
+
+        # Compute the refined contributions to each element at once
+        nodes = conn_refine[start:end, :]
+        upts = (Xpts_refine[nodes, :2] - pt[:, np.newaxis, :]) / max_dist
+        N = recon_basis(degree, upts)
+        uvals_refine += np.bincount(
+            nodes.ravel(),
+            weights=np.einsum("end,ed->en", N, vals).ravel(),
+            minlength=nrefine,
+        )
 
     # Average the values
     uvals_refine /= count
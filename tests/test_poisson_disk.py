@@ -0,0 +1,115 @@
+import ast
+import os
+import types
+import unittest
+
+import numpy as np
+
+# The poisson example runs as a script, so only load the functions and
+# module-level constants needed to evaluate the exact disk aggregates
+POISSON_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "examples",
+    "poisson",
+    "poisson.py",
+)
+POISSON_NAMES = [
+    "glpts6",
+    "glwts6",
+    "get_quadrature_pts",
+    "quadrature",
+    "estrin",
+    "disk_coef",
+    "disk_grad_coef",
+    "get_disk_grad_max",
+    "disk_grad_max",
+    "get_disk_aggregate",
+]
+
+
+def load_poisson():
+    with open(POISSON_PATH) as fp:
+        tree = ast.parse(fp.read())
+
+    body = []
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name in POISSON_NAMES:
+            body.append(node)
+        elif isinstance(node, ast.Assign) and any(
+            isinstance(t, ast.Name) and t.id in POISSON_NAMES for t in node.targets
+        ):
+            body.append(node)
+
+    # Evaluate the NumPy fallback rather than the compiled kernel
+    MPI = types.SimpleNamespace(IN_PLACE="in_place", SUM="sum")
+    ns = {"np": np, "MPI": MPI, "disk_kernel": None}
+    code = compile(ast.Module(body=body, type_ignores=[]), POISSON_PATH, "exec")
+    exec(code, ns)
+    return ns
+
+
+class FakeComm:
+    """
+    Communicator that mimics the in-place Allreduce of a single rank in
+    a communicator of the given size, given the partial contributions
+    of all of the ranks
+    """
+
+    def __init__(self, rank, size, partials=None):
+        self.rank = rank
+        self.size = size
+        self.partials = partials
+        self.local = None
+
+    def Allreduce(self, sendbuf, recvbuf, op=None):
+        self.local = recvbuf.copy()
+        if self.partials is not None:
+            recvbuf[:] = np.sum(self.partials, axis=0)
+
+
+class DiskAggregateTest(unittest.TestCase):
+    def check_parallel(self, functional, n, size):
+        ns = load_poisson()
+        get_disk_aggregate = ns["get_disk_aggregate"]
+        R = 100.0
+        rho = 50.0
+
+        # Ensure that the per-rank theta ranges are not a multiple of the
+        # block size, so that the last block on each rank is partial
+        block = max(1, 2**17 // (6 * n))
+        step = (12 * n) // size
+        self.assertNotEqual(step % block, 0)
+
+        # Compute the contributions from each rank, then the aggregate
+        partials = []
+        for rank in range(size):
+            comm = FakeComm(rank, size)
+            get_disk_aggregate(comm, functional, rho, R, n=n)
+            partials.append(comm.local)
+
+        # The ranks must only write into their own range of theta
+        for rank in range(size):
+            start = step * rank
+            end = len(partials[rank]) if rank == size - 1 else step * (rank + 1)
+            self.assertTrue(np.all(partials[rank][:start] == 0.0))
+            self.assertTrue(np.all(partials[rank][end:] == 0.0))
+
+        serial = get_disk_aggregate(FakeComm(0, 1), functional, rho, R, n=n)
+        parallel = get_disk_aggregate(
+            FakeComm(0, size, partials), functional, rho, R, n=n
+        )
+        self.assertAlmostEqual(serial[0], parallel[0], places=14)
+        self.assertAlmostEqual(serial[1], parallel[1], places=12)
+
+    def test_ks_grad(self):
+        for size in [2, 4]:
+            self.check_parallel("ks_grad", 500, size)
+
+    def test_pnorm_grad(self):
+        for size in [2, 4]:
+            self.check_parallel("pnorm_grad", 500, size)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2280,6 +2280,35 @@ cdef class ElementFeatureSize:
         pt.z = x[2]
         return self.ptr.getFeatureSize(pt)
 
+    def getFeatureSizes(self, np.ndarray[double, ndim=2, mode='c'] X):
+        """
+        getFeatureSizes(self, X)
+
+        Evaluate the feature size at each point in an (n,3) array
+
+        Args:
+            X (np.ndarray): The (n,3) array of points
+
+        Returns:
+            np.ndarray: The feature size at each point
+        """
+        cdef int i = 0
+        cdef int npts = 0
+        cdef TMRPoint pt
+        cdef np.ndarray[double, ndim=1, mode='c'] h
+        if X.shape[1] != 3:
+            errmsg = 'ElementFeatureSize expecting point (n,3) array'
+            raise ValueError(errmsg)
+
+        npts = X.shape[0]
+        h = np.zeros(npts, dtype=np.double)
+        for i in range(npts):
+            pt.x = X[i,0]
+            pt.y = X[i,1]
+            pt.z = X[i,2]
+            h[i] = self.ptr.getFeatureSize(pt)
+        return h
+
 cdef class ConstElementSize(ElementFeatureSize):
     def __cinit__(self, double h):
         self.ptr = new TMRElementFeatureSize(h)
@@ -6020,12 +6049,18 @@ def setMatchingFaces(model_list, double tol=1e-6):
         verts.extend(geo.getVertices())
         edges.extend(geo.getEdges())
 
-    while len(verts) > 0:
-        vert = verts.pop()
-        for v in verts[:]:
-            if vert.checkMatching(v, tol=tol):
-                v.setCopySource(vert)
-                verts.remove(v)
+    # Evaluate the vertex locations once and find the coincident
+    # vertices by comparing each against all remaining vertices at once
+    if len(verts) > 0:
+        Xv = np.array([v.evalPoint() for v in verts])
+        remaining = np.ones(len(verts), dtype=bool)
+        for i in range(len(verts)-1, -1, -1):
+            if remaining[i]:
+                remaining[i] = False
+                match = np.all(np.abs(Xv - Xv[i]) < tol, axis=1) & remaining
+                for j in np.nonzero(match)[0]:
+                    verts[j].setCopySource(verts[i])
+                remaining[match] = False
 
     while len(edges) > 0:
         edge = edges.pop()
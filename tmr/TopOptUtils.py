@@ -425,31 +425,29 @@ def densityBasedRefine(
         max_lev (int): Maximum refinement level
     """
 
-    # Create refinement array
-    num_elems = assembler.getNumElements()
-    refine = np.zeros(num_elems, dtype=np.int32)
-
     # Get the elements from the Assembler object
+    num_elems = assembler.getNumElements()
     elems = assembler.getElements()
 
+    # Extract the min or max density value within each element
+    values = np.zeros(num_elems)
     for i in range(num_elems):
-        # Extract the design variables from the element
         dvs_per_node = elems[i].getDesignVarsPerNode()
         dvs = elems[i].getDesignVars(i)
-
-        # Apply the refinement criteria
         if reverse:
-            value = np.min(dvs[index::dvs_per_node])
-            if value >= upper:
-                refine[i] = -1
-            elif value <= lower:
-                refine[i] = 1
+            values[i] = np.min(dvs[index::dvs_per_node])
         else:
-            value = np.max(dvs[index::dvs_per_node])
-            if value >= upper:
-                refine[i] = 1
-            elif value <= lower:
-                refine[i] = -1
+            values[i] = np.max(dvs[index::dvs_per_node])
+
+    # Apply the refinement criteria to all the elements at once. The
+    # upper limit is applied last so that it takes precedence.
+    refine = np.zeros(num_elems, dtype=np.int32)
+    if reverse:
+        refine[values <= lower] = 1
+        refine[values >= upper] = -1
+    else:
+        refine[values <= lower] = -1
+        refine[values >= upper] = 1
 
     # Refine the forest
     forest.refine(refine, min_lev=min_lev, max_lev=max_lev)